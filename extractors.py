@@ -0,0 +1,66 @@
+# backend/extractors.py
+# Page -> text extraction, run inside server.EXTRACTOR_POOL workers.
+# Keep this module free of import-time side effects (no DB, app, clients, caches):
+# every pool worker imports it.
+import io, re
+from typing import List
+
+import pypdfium2 as pdfium
+import trafilatura
+from resiliparse.extract.html2text import extract_plain_text
+from resiliparse.parse.encoding import detect_encoding
+from resiliparse.parse.html import HTMLTree
+
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)")
+
+def html_to_text(content: bytes, ctype: str) -> str:
+    """
+    Main-content text via resiliparse; trafilatura only if resiliparse fails.
+    """
+    m = _CHARSET_RE.search(ctype)
+    enc = m.group(1) if m else detect_encoding(content)
+    try:
+        tree = HTMLTree.parse_from_bytes(content, enc)
+        # keep block-level newlines: extract_snippets works line by line
+        return extract_plain_text(tree, main_content=True, alt_texts=False, preserve_formatting=True)
+    except Exception:
+        return trafilatura.extract(content.decode(errors="ignore")) or ""
+
+def pdf_to_text(content: bytes, max_pages: int, max_chars: int) -> str:
+    """
+    Text of the first max_pages pages via pdfium; pdfminer.six (if installed) as fallback.
+    """
+    try:
+        parts: List[str] = []
+        got = 0
+        pdf = pdfium.PdfDocument(content)
+        try:
+            for i in range(min(max_pages, len(pdf))):
+                t = pdf[i].get_textpage().get_text_range()
+                parts.append(t)
+                got += len(t)
+                if got >= max_chars:
+                    break  # truncated to max_chars anyway
+        finally:
+            pdf.close()
+        return "\n".join(parts)
+    except Exception:
+        pass
+    try:
+        from pdfminer.high_level import extract_text_to_fp
+        out = io.StringIO()
+        extract_text_to_fp(io.BytesIO(content), out, maxpages=max_pages)
+        return out.getvalue()
+    except Exception:
+        return ""
+
+def extract_sync(content: bytes, ctype: str, url: str, max_chars: int, pdf_pages: int) -> str:
+    # One single-threaded process per pool worker, so pdfium needs no lock.
+    try:
+        if "pdf" in ctype or url.lower().endswith(".pdf"):
+            text = pdf_to_text(content, pdf_pages, max_chars)
+        else:
+            text = html_to_text(content, ctype)
+    except Exception:
+        text = ""
+    return (text or "")[:max_chars]
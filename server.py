@@ -1,21 +1,35 @@
 # backend/server.py
-import os, re, json, time, html, asyncio
-from typing import Any, Dict, List, AsyncGenerator, Tuple
+import os, re, time, html, zlib, asyncio, functools, hashlib, logging, multiprocessing, sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import aclosing
+from typing import Any, Dict, List, AsyncGenerator, AsyncIterator, Optional, Tuple
+from urllib.parse import urlsplit
 
 import httpx
-import trafilatura
+import numpy as np
+import orjson
+from datasketch import MinHash, MinHashLSH
 from ddgs import DDGS
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
+from ollama import AsyncClient as OllamaAsyncClient
 from ollama import chat as ollama_chat
 
+from extractors import extract_sync
+
 # =========================================================
 # CONFIG
 # =========================================================
 # Models
 FAST_MODEL = "qwen2.5:1.5b"      # Fast mode (keep whatever you already use)
-THOROUGH_MODEL = "llama3.1:8b"   # Ultra-Thorough (router+planner+synth)
+THOROUGH_MODEL = "llama3.1:8b-q4km"   # Ultra-Thorough (router+planner+synth); Q4_K_M build, see Modelfile
+# Per-model Ollama options merged into every call
+MODEL_OPTIONS: Dict[str, Dict[str, Any]] = {
+    THOROUGH_MODEL: {"num_ctx": 8192, "num_batch": 512},  # big evidence prompts prefill in larger batches
+}
 
 # CORS (front-end dev)
 ALLOWED_ORIGINS = [
@@ -34,18 +48,32 @@ PLANNER_QUERIES_STAGE1 = 6
 PLANNER_QUERIES_STAGE2 = 5
 PER_QUERY_RESULTS = 10
 FETCH_CONCURRENCY = 10
+TOTAL_FETCH_BUDGET = 45.0   # seconds per fetch_many pass; stragglers are dropped
+USER_AGENT = "Mozilla/5.0 (compatible; NebulaResearch/1.0)"
 MAX_PER_HOST = 2
+# In-flight fetches per host. The dedupe loops already pass at most MAX_PER_HOST URLs per
+# host, so this only binds below that: at 1, a host's second URL waits on the host instead
+# of holding a global FETCH_CONCURRENCY permit behind a slow first fetch.
+FETCH_PER_HOST = 1
 MAX_DOCS_STAGE1 = 12
 MAX_DOCS_TOTAL  = 24
 EXTRACT_CHARS_HTML = 3000
 PDF_PAGE_MAX = 12
 BYTES_CAP = 2_000_000
+NEAR_DUP_JACCARD = 0.8     # factlets above this similarity are dropped
+MINHASH_PERM = 64
 SYNTH_TEMP = 0.25
+MAX_EVIDENCE_TOKENS = 6000   # synthesis prompt budget (fits num_ctx with room for the answer)
+DOC_SUMMARY_TOKENS = 200     # per-doc target when evidence has to be condensed
+ROUTER_CACHE_TTL = 3600.0            # planner replies go stale quickly
+SYNTH_CACHE_TTL = 30 * 24 * 3600.0   # same question + same evidence -> same answer
 RETRIEVE_GATE_TAU = 0.45   # avg(freshness, uncertainty)
 
 # Caching & “learning” (tiny domain prior)
 CACHE_DIR = os.path.join(os.path.expanduser("~"), ".nebula_cache")
 os.makedirs(CACHE_DIR, exist_ok=True)
+CACHE_DB_FILE = os.path.join(CACHE_DIR, "cache.db")
+# pre-SQLite JSON stores, imported once into CACHE_DB_FILE
 DOMAIN_PRIOR_FILE = os.path.join(CACHE_DIR, "domain_prior.json")
 SEARCH_CACHE_FILE = os.path.join(CACHE_DIR, "search_cache.json")
 
@@ -64,44 +92,111 @@ app.add_middleware(
 # =========================================================
 # PERSISTENT STATE
 # =========================================================
-try:
-    with open(DOMAIN_PRIOR_FILE, "r") as f:
-        DOMAIN_PRIOR: Dict[str, float] = json.load(f)
-except Exception:
-    DOMAIN_PRIOR = {}
-
-try:
-    with open(SEARCH_CACHE_FILE, "r") as f:
-        SEARCH_CACHE: Dict[str, List[Dict[str, str]]] = json.load(f)
-except Exception:
-    SEARCH_CACHE = {}
+# SQLite in WAL mode: each search / domain bump is a single-row upsert instead of
+# rewriting a whole JSON file. The dicts below mirror the tables for reads.
+# check_same_thread=False: the loop may run on a thread other than the importer's.
+# All access stays on the loop thread, with no await between BEGIN and COMMIT.
+DB = sqlite3.connect(CACHE_DB_FILE, isolation_level=None, check_same_thread=False)
+DB.execute("PRAGMA journal_mode=WAL")
+DB.execute("PRAGMA synchronous=NORMAL")
+DB.execute("CREATE TABLE IF NOT EXISTS search_cache (query TEXT PRIMARY KEY, results BLOB)")
+DB.execute("CREATE TABLE IF NOT EXISTS domain_prior (host TEXT PRIMARY KEY, score REAL)")
+DB.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, content TEXT, expires REAL)")
+DB.execute("DELETE FROM llm_cache WHERE expires < ?", (time.time(),))
+
+def _import_json(path: str, sql: str, rows):
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+        DB.execute("BEGIN")
+        DB.executemany(sql, rows(data))
+        DB.execute("COMMIT")
+        os.replace(path, path + ".imported")
+    except Exception:
+        if DB.in_transaction:
+            DB.execute("ROLLBACK")
+
+_import_json(DOMAIN_PRIOR_FILE, "INSERT OR REPLACE INTO domain_prior VALUES (?, ?)",
+             lambda d: d.items())
+_import_json(SEARCH_CACHE_FILE, "INSERT OR REPLACE INTO search_cache VALUES (?, ?)",
+             lambda d: ((q, orjson.dumps(r)) for q, r in d.items()))
+
+DOMAIN_PRIOR: Dict[str, float] = dict(DB.execute("SELECT host, score FROM domain_prior"))
+SEARCH_CACHE: Dict[str, List[Dict[str, str]]] = {
+    q: orjson.loads(r) for q, r in DB.execute("SELECT query, results FROM search_cache")
+}
+_DIRTY_HOSTS: set = set()  # bumped since the last _save_domain_prior()
 
 DOC_CACHE: Dict[str, str] = {}  # in-memory per-process
 
+OLLAMA = OllamaAsyncClient()  # streaming calls
+
+log = logging.getLogger("nebula")
+
+# HTML/PDF extraction is CPU-bound; keep it off the event loop. Built in _startup.
+EXTRACTOR_POOL: Optional[ProcessPoolExecutor] = None
+
+def _new_extractor_pool() -> ProcessPoolExecutor:
+    # forkserver/spawn: workers don't inherit DDG threads or the DB handle, and since they
+    # only import extractors (not this module) they don't reopen them either
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
+
 def _save_domain_prior():
+    # flush all pending bumps in one transaction
+    if not _DIRTY_HOSTS:
+        return
+    rows = [(h, DOMAIN_PRIOR[h]) for h in _DIRTY_HOSTS]
+    _DIRTY_HOSTS.clear()
     try:
-        with open(DOMAIN_PRIOR_FILE, "w") as f:
-            json.dump(DOMAIN_PRIOR, f)
+        DB.execute("BEGIN")
+        DB.executemany(
+            "INSERT INTO domain_prior (host, score) VALUES (?, ?) "
+            "ON CONFLICT(host) DO UPDATE SET score = excluded.score",
+            rows,
+        )
+        DB.execute("COMMIT")
     except Exception:
-        pass
+        if DB.in_transaction:
+            DB.execute("ROLLBACK")
 
-def _save_search_cache():
+def _save_search_cache(query: str):
     try:
-        with open(SEARCH_CACHE_FILE, "w") as f:
-            json.dump(SEARCH_CACHE, f)
+        DB.execute(
+            "INSERT OR REPLACE INTO search_cache (query, results) VALUES (?, ?)",
+            (query, orjson.dumps(SEARCH_CACHE[query])),
+        )
     except Exception:
         pass
 
 # =========================================================
 # UTILITIES
 # =========================================================
+_TOKEN_RE = re.compile(r"[a-z0-9]{3,}")
+_RECENCY_RE = re.compile(r"\b(2024|2025|latest|recent|q[1-4])\b", re.I)
+_SENT_SPLIT_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+_CITE_RE = re.compile(r"\[(\d+)\]")
+_PIECE_RE = re.compile(r"\w{1,6}|[^\w\s]")
+
 def now() -> float:
     return time.monotonic()
 
+def _tokens(s: str) -> set:
+    return set(_TOKEN_RE.findall(s.lower()))
+
+def is_http(url: str) -> bool:
+    # plain prefix check; no regex on every search result
+    return url[:8].lower().startswith(("http://", "https://"))
+
+@functools.lru_cache(maxsize=4096)
 def host_of(url: str) -> str:
-    m = re.search(r"https?://([^/]+)", url, re.I)
-    if not m: return ""
-    h = m.group(1).lower()
+    # same URL is looked up in dedupe, fetch, ranking and citation checks
+    try:
+        h = urlsplit(url).hostname or ""  # already lowercased, no port/userinfo
+    except ValueError:
+        return ""
     return h[4:] if h.startswith("www.") else h
 
 def score_domain(host: str) -> float:
@@ -111,24 +206,83 @@ def score_domain(host: str) -> float:
 def bump_domain(host: str, delta: float):
     if not host: return
     DOMAIN_PRIOR[host] = max(0.0, min(1.0, DOMAIN_PRIOR.get(host, 0.25) + delta))
+    _DIRTY_HOSTS.add(host)
+
+def _llm_key(model: str, messages: List[Dict[str, str]], temperature: float) -> str:
+    return hashlib.blake2b(orjson.dumps((model, messages, temperature)), digest_size=16).hexdigest()
+
+def _llm_cache_get(key: str) -> Optional[str]:
+    # any DB error is a miss: the cache must never fail a request
+    try:
+        row = DB.execute("SELECT content FROM llm_cache WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+    except Exception:
+        return None
+    return row[0] if row else None
 
-def llm(model: str, messages: List[Dict[str, str]], temperature: float = 0.25) -> str:
-    out = ollama_chat(model=model, messages=messages, options={"temperature": temperature})
-    return out["message"]["content"]
+def _llm_cache_put(key: str, content: str, ttl: float):
+    try:
+        DB.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)", (key, content, time.time() + ttl))
+    except Exception:
+        pass
 
-def llm_json(model: str, messages: List[Dict[str, str]], temperature: float = 0.1) -> Dict[str, Any]:
-    raw = llm(model, messages, temperature=temperature).strip()
-    s, e = raw.find("{"), raw.rfind("}")
+def llm(model: str, messages: List[Dict[str, str]], temperature: float = 0.25, cache_ttl: float = 0.0) -> str:
+    # cache_ttl > 0: reuse an identical (model, messages, temperature) reply for that many seconds
+    key = _llm_key(model, messages, temperature) if cache_ttl > 0 else ""
+    if key:
+        hit = _llm_cache_get(key)
+        if hit is not None:
+            return hit
+    out = ollama_chat(model=model, messages=messages, options={"temperature": temperature, **MODEL_OPTIONS.get(model, {})})
+    content = out["message"]["content"]
+    if key:
+        _llm_cache_put(key, content, cache_ttl)
+    return content
+
+async def llm_stream(model: str, messages: List[Dict[str, str]], temperature: float = 0.25, cache_ttl: float = 0.0) -> AsyncIterator[str]:
+    """
+    Like llm(), but yields the reply chunk by chunk. Closing the generator early closes
+    the Ollama stream, which stops generation; partial replies are not cached.
+    """
+    key = _llm_key(model, messages, temperature) if cache_ttl > 0 else ""
+    if key:
+        hit = _llm_cache_get(key)
+        if hit is not None:
+            yield hit
+            return
+    parts: List[str] = []
+    options = {"temperature": temperature, **MODEL_OPTIONS.get(model, {})}
+    stream = await OLLAMA.chat(model=model, messages=messages, options=options, stream=True)
+    async with aclosing(stream):
+        async for chunk in stream:
+            tok = chunk["message"]["content"]
+            if tok:
+                parts.append(tok)
+                yield tok
+    if key:
+        _llm_cache_put(key, "".join(parts), cache_ttl)
+
+def llm_json(model: str, messages: List[Dict[str, str]], temperature: float = 0.1, cache_ttl: float = 0.0) -> Dict[str, Any]:
+    # cache_ttl > 0: like llm(), but only replies that parse to a non-empty object are stored,
+    # so a garbled reply isn't replayed to every retry for the whole TTL
+    key = _llm_key(model, messages, temperature) if cache_ttl > 0 else ""
+    hit = _llm_cache_get(key) if key else None
+    raw = hit if hit is not None else llm(model, messages, temperature=temperature)
+    body = raw.strip()
+    s, e = body.find("{"), body.rfind("}")
     if s != -1 and e != -1 and e > s:
-        raw = raw[s:e+1]
+        body = body[s:e+1]
     try:
-        return json.loads(raw)
+        js = orjson.loads(body)
     except Exception:
         return {}
+    if not isinstance(js, dict):
+        return {}
+    if key and hit is None and js:
+        _llm_cache_put(key, raw, cache_ttl)
+    return js
 
-def ddg_search(query: str, k: int) -> List[Dict[str, str]]:
-    if query in SEARCH_CACHE:
-        return SEARCH_CACHE[query]
+def _ddg_text(query: str, k: int) -> List[Dict[str, str]]:
+    # blocking; run via ddg_search_async
     out: List[Dict[str, str]] = []
     with DDGS(timeout=25) as ddgs:
         for r in ddgs.text(query, region="wt-wt", max_results=k):
@@ -136,55 +290,96 @@ def ddg_search(query: str, k: int) -> List[Dict[str, str]]:
             t = r.get("title") or ""
             if u and t:
                 out.append({"title": t, "url": u})
-    SEARCH_CACHE[query] = out
-    _save_search_cache()
     return out
 
-async def fetch_many(urls: List[str], client: httpx.AsyncClient) -> Dict[str, Tuple[str, str]]:
+async def ddg_search_async(query: str, k: int) -> Tuple[str, List[Dict[str, str]]]:
+    if query in SEARCH_CACHE:
+        return query, SEARCH_CACHE[query]
+    try:
+        out = await asyncio.to_thread(_ddg_text, query, k)
+    except Exception as e:
+        # rate limit / network error: drop this query only, and don't cache the miss
+        log.warning("search failed for %r: %s", query, e)
+        return query, []
+    SEARCH_CACHE[query] = out
+    _save_search_cache(query)
+    return query, out
+
+async def search_all(queries: List[str], k: int, budget: float) -> AsyncGenerator[Tuple[str, List[Dict[str, str]]], None]:
+    """
+    Run all queries concurrently and yield (query, results) as each one finishes,
+    giving up on whatever is still pending after `budget` seconds.
+    """
+    if budget <= 0:
+        return
+    tasks = [asyncio.create_task(ddg_search_async(q, k)) for q in queries]
+    try:
+        for fut in asyncio.as_completed(tasks, timeout=budget):
+            yield await fut
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for t in tasks:
+            t.cancel()
+
+async def extract_text(content: bytes, ctype: str, url: str) -> str:
+    """
+    extractors.extract_sync in EXTRACTOR_POOL. A dead worker (native crash, OOM kill) breaks the
+    whole pool, so swap in a fresh one and retry once rather than failing every later fetch.
+    """
+    global EXTRACTOR_POOL
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        if EXTRACTOR_POOL is None:
+            EXTRACTOR_POOL = _new_extractor_pool()
+        pool = EXTRACTOR_POOL
+        try:
+            return await loop.run_in_executor(
+                pool, extract_sync, content, ctype, url, EXTRACT_CHARS_HTML, PDF_PAGE_MAX
+            )
+        except BrokenProcessPool:
+            log.warning("extractor pool broken while extracting %s; restarting it", url)
+            if EXTRACTOR_POOL is pool:  # other fetches may have replaced it already
+                EXTRACTOR_POOL = _new_extractor_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+    return ""
+
+async def fetch_many(urls: List[str], client: httpx.AsyncClient, budget: float = TOTAL_FETCH_BUDGET) -> Dict[str, Tuple[str, str]]:
     """
     Return {url: (mime, text)} where text is extracted main content (HTML) or PDF text if possible.
+    Fetches still running after `budget` seconds are cancelled and left out.
     """
     sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    host_sems: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(FETCH_PER_HOST))
     results: Dict[str, Tuple[str, str]] = {}
 
     async def _one(u: str):
         if u in DOC_CACHE:
             results[u] = ("text/plain", DOC_CACHE[u])
             return
-        if not re.match(r"^https?://", u, re.I):
+        if not is_http(u):
             return
-        async with sem:
+        # host permit first: tasks queued behind a slow host don't hold global permits
+        async with host_sems[host_of(u)], sem:
             try:
                 r = await client.get(u, timeout=20.0, follow_redirects=True)
                 if r.status_code != 200:
                     return
                 ctype = (r.headers.get("content-type") or "").lower()
                 content = r.content[:BYTES_CAP]
-                text = ""
-                if "pdf" in ctype or u.lower().endswith(".pdf"):
-                    # Optional: pdfminer.six (if installed)
-                    try:
-                        from pdfminer.high_level import extract_text_to_fp
-                        import io
-                        bio = io.BytesIO(content)
-                        out = io.StringIO()
-                        extract_text_to_fp(bio, out, maxpages=PDF_PAGE_MAX)
-                        text = out.getvalue()
-                    except Exception:
-                        text = ""
-                else:
-                    try:
-                        text = trafilatura.extract(content.decode(errors="ignore")) or ""
-                    except Exception:
-                        text = ""
-                text = (text or "")[:EXTRACT_CHARS_HTML]
+                text = await extract_text(content, ctype, u)
                 if text:
                     DOC_CACHE[u] = text
                     results[u] = (ctype or "text/plain", text)
             except Exception:
                 return
 
-    await asyncio.gather(*[_one(u) for u in urls])
+    if not urls:
+        return results
+    tasks = [asyncio.create_task(_one(u)) for u in urls]
+    _, pending = await asyncio.wait(tasks, timeout=max(0.0, budget), return_when=asyncio.ALL_COMPLETED)
+    for t in pending:
+        t.cancel()
     return results
 
 # Ranking & compression
@@ -193,24 +388,48 @@ EVIDENCE_PATTERNS = [
     r"\bmoat\b", r"\bmarket share\b", r"\bforecast\b", r"\bresult(s)?\b",
     r"\bregulat(?:ion|ory)\b", r"\bquarter\b", r"\bFY20(24|25)\b",
 ]
-
-def composite_score(question: str, text: str, url: str) -> float:
-    q_terms = set(re.findall(r"[a-z0-9]{3,}", question.lower()))
-    t_terms = set(re.findall(r"[a-z0-9]{3,}", text.lower()))
-    if not t_terms: return 0.0
-    overlap = len(q_terms & t_terms) / (len(q_terms) or 1)
-    relevance = min(1.0, 1.5 * overlap)
-    recency = 1.0 if re.search(r"\b(2024|2025|latest|recent|q[1-4])\b", question.lower()) else 0.4
-    trust = score_domain(host_of(url))
-    structure = 0.6 if len(text) > 800 else 0.2
-    return 0.40*relevance + 0.30*recency + 0.20*trust + 0.10*structure
+_EVIDENCE_RE = re.compile("|".join(EVIDENCE_PATTERNS), re.I)
+
+def composite_scores(question: str, token_sets: List[set], lens: np.ndarray, domain_scores: np.ndarray) -> np.ndarray:
+    # relevance/recency/trust/structure blend, one score per document
+    q_terms = _tokens(question)
+    recency = 1.0 if _RECENCY_RE.search(question) else 0.4
+    overlaps = np.array([len(q_terms & t) for t in token_sets], dtype=np.float64)
+    relevance = np.minimum(1.0, 1.5 * overlaps / (len(q_terms) or 1))
+    structure = np.where(lens > 800, 0.6, 0.2)
+    scores = 0.40*relevance + 0.30*recency + 0.20*domain_scores + 0.10*structure
+    return np.where(np.array([bool(t) for t in token_sets], dtype=bool), scores, 0.0)
+
+def _occurrence_rank(keys: np.ndarray) -> np.ndarray:
+    # for each position: how many earlier positions share its key
+    _, inv, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    by_key = np.argsort(inv.ravel(), kind="stable")
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    rank = np.empty(len(keys), dtype=np.intp)
+    rank[by_key] = np.arange(len(keys)) - starts
+    return rank
+
+def select_docs(question: str, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Rank docs best-first and keep at most MAX_PER_HOST per host, MAX_DOCS_TOTAL overall.
+    """
+    if not docs:
+        return []
+    # hot fields as parallel arrays rather than per-dict lookups
+    hosts = np.array([host_of(d["url"]) for d in docs], dtype=object)
+    lens = np.array([d["_len"] for d in docs], dtype=np.int32)
+    token_sets = [d["_tokens"] for d in docs]
+    domain_scores = np.array([score_domain(h) for h in hosts], dtype=np.float32)
+    scores = composite_scores(question, token_sets, lens, domain_scores)
+    order = np.argsort(-scores, kind="stable")  # stable, like sorted(): ties keep fetch order
+    order = order[_occurrence_rank(hosts[order]) < MAX_PER_HOST][:MAX_DOCS_TOTAL]
+    return [docs[i] for i in order]
 
 def extract_snippets(text: str, max_snippets: int = 8) -> List[str]:
     lines = [ln.strip() for ln in text.split("\n") if ln.strip()]
-    pat = re.compile("|".join(EVIDENCE_PATTERNS), re.I)
     hits = []
     for ln in lines:
-        if pat.search(ln):
+        if _EVIDENCE_RE.search(ln):
             hits.append(ln[:280])
         if len(hits) >= max_snippets:
             break
@@ -218,47 +437,107 @@ def extract_snippets(text: str, max_snippets: int = 8) -> List[str]:
         hits = [ln[:280] for ln in lines[:max_snippets]]
     return hits
 
-def near_duplicate(a: str, b: str) -> bool:
-    ta = set(re.findall(r"[a-z0-9]{3,}", a.lower()))
-    tb = set(re.findall(r"[a-z0-9]{3,}", b.lower()))
-    if not ta or not tb: return False
-    j = len(ta & tb) / len(ta | tb)
-    return j > 0.8
-
-def compress_docs_to_factlets(docs: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+def make_doc(url: str, text: str) -> Dict[str, Any]:
+    # one pass over the text at ingest; ranking, compression and verification reuse these
+    return {
+        "url": url,
+        "text": text,
+        "_tokens": _tokens(text),
+        "_len": len(text),
+        "_snips": extract_snippets(text, max_snippets=8),
+    }
+
+def _hash32(tok: str) -> int:
+    # stable across processes (unlike salted hash()), so dedupe -- and the evidence
+    # blob that keys the synthesis cache -- is the same after a restart
+    return zlib.crc32(tok.encode())
+
+def compress_docs_to_factlets(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     factlets: List[Dict[str, Any]] = []
     for i, d in enumerate(docs, start=1):
-        snips = extract_snippets(d["text"], max_snippets=8)
-        for s in snips[:10]:
+        for s in d["_snips"][:10]:
             factlets.append({
                 "doc": i,
                 "url": d["url"],
                 "host": host_of(d["url"]),
                 "text": s
             })
+    # Near-duplicate filter: MinHash signatures bucketed by LSH bands instead of
+    # pairwise Jaccard against every kept factlet.
+    # bulk() shares one permutation table across signatures; crc32 stands in for
+    # datasketch's per-token SHA-1.
+    token_sets = [_tokens(f["text"]) for f in factlets]
+    sigs = MinHash.bulk(token_sets, num_perm=MINHASH_PERM, hashfunc=_hash32)
+    lsh = MinHashLSH(threshold=NEAR_DUP_JACCARD, num_perm=MINHASH_PERM)
     keep: List[Dict[str, Any]] = []
-    for f in factlets:
-        if any(near_duplicate(f["text"], g["text"]) for g in keep):
-            continue
+    for f, toks, m in zip(factlets, token_sets, sigs):
+        if toks:
+            if lsh.query(m):
+                continue
+            lsh.insert(len(keep), m)
         keep.append(f)
         if len(keep) >= 600:
             break
     return keep
 
+def approx_tokens(s: str) -> int:
+    # rough BPE-style count (words in <=6-char pieces + punctuation); no llama tokenizer in-process
+    return len(_PIECE_RE.findall(s))
+
+def cap_tokens(text: str, budget: int) -> str:
+    # keep whole lines while they fit
+    out: List[str] = []
+    used = 0
+    for ln in text.split("\n"):
+        used += approx_tokens(ln) + 1
+        if used > budget:
+            break
+        out.append(ln)
+    return "\n".join(out)
+
+async def condense_shards(question: str, shards: List[str]) -> List[str]:
+    """
+    Map step for oversized evidence: shards (one "[n] url" block per doc) above their
+    share of MAX_EVIDENCE_TOKENS are summarized by FAST_MODEL into short bullets.
+    """
+    share = MAX_EVIDENCE_TOKENS // max(1, len(shards))
+
+    async def _one(shard: str) -> str:
+        if approx_tokens(shard) <= share:
+            return shard
+        head, _, body = shard.partition("\n")
+        msgs = [
+            {"role": "system", "content": (
+                "Condense the evidence bullets into at most 5 short bullets (about "
+                f"{DOC_SUMMARY_TOKENS} tokens total) relevant to the question. "
+                "Keep numbers, dates and names exactly. Output only lines starting with '- '."
+            )},
+            {"role": "user", "content": f"Question:\n{question}\n\nEvidence:\n{body}"},
+        ]
+        try:
+            summary = "".join([t async for t in llm_stream(FAST_MODEL, msgs, temperature=0.1, cache_ttl=SYNTH_CACHE_TTL)])
+        except Exception:
+            summary = body
+        return head + "\n" + cap_tokens(summary.strip(), max(share, DOC_SUMMARY_TOKENS))
+
+    return list(await asyncio.gather(*[_one(sh) for sh in shards]))
+
 # Verification
 def split_sentences(md: str) -> List[str]:
-    parts = re.split(r'(?<=[.!?])\s+|\n+', md.strip())
-    return [p.strip() for p in parts if p.strip()]
+    parts = (p.strip() for p in _SENT_SPLIT_RE.split(md.strip()))
+    return [p for p in parts if p]
+
+def is_bare_citation(sent: str) -> bool:
+    # "[3]" left on its own by the splitter; sentences are already stripped
+    return sent.startswith("[") and sent.endswith("]") and sent[1:-1].isascii() and sent[1:-1].isdigit()
 
-def sentence_supported(sent: str, evidence_blob: str) -> bool:
-    a = set(re.findall(r"[a-z0-9]{3,}", sent.lower()))
-    b = set(re.findall(r"[a-z0-9]{3,}", evidence_blob.lower()))
-    if not a or not b: return False
-    overlap = len(a & b) / len(a)
-    return overlap >= 0.45
+def sentence_supported(sent: str, ev_tokens: set) -> bool:
+    # ev_tokens = _tokens(evidence_blob), computed once per answer
+    a = _tokens(sent)
+    return bool(a) and len(a & ev_tokens) / len(a) >= 0.45
 
 def validate_citations(answer: str, docs: List[Dict[str, str]]) -> List[str]:
-    indices = set(int(m.group(1)) for m in re.finditer(r"\[(\d+)\]", answer))
+    indices = set(int(m.group(1)) for m in _CITE_RE.finditer(answer))
     urls = []
     for idx in sorted(indices):
         if 1 <= idx <= len(docs):
@@ -321,6 +600,7 @@ def router_plan(question: str, max_queries: int, per_query_results: int) -> Dict
         THOROUGH_MODEL,
         [{"role": "system", "content": ROUTER_SYS}, {"role": "user", "content": user}],
         temperature=0.15,
+        cache_ttl=ROUTER_CACHE_TTL,
     )
     if "needs_retrieval" not in js:
         js["needs_retrieval"] = True
@@ -332,7 +612,7 @@ def router_plan(question: str, max_queries: int, per_query_results: int) -> Dict
     js.setdefault("budgets", {"seconds": TARGET_BUDGET, "per_query_results": per_query_results})
     return js
 
-async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]:
+async def thorough_stream(question: str, client: httpx.AsyncClient) -> AsyncGenerator[Dict[str, Any], None]:
     t0 = now()
     def elapsed() -> float: return now() - t0
 
@@ -372,12 +652,12 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
 
     # Discover pass 1
     yield {"type": "status", "data": {"state": "Searching the web (pass 1)" }}
-    results1: List[Dict[str, str]] = []
-    for q in plan1["queries"]:
-        if elapsed() > HARD_BUDGET: break
-        res = ddg_search(q, plan1["budgets"]["per_query_results"])
-        results1.extend([{"query": q, **r} for r in res])
+    found1: Dict[str, List[Dict[str, str]]] = {}
+    async for q, res in search_all(plan1["queries"], plan1["budgets"]["per_query_results"], HARD_BUDGET - elapsed()):
+        found1[q] = res
         yield {"type": "search", "data": {"query": q, "results": res}}
+    # planner order, not completion order, so dedupe stays deterministic
+    results1 = [{"query": q, **r} for q in plan1["queries"] for r in found1.get(q, [])]
     yield {"type": "progress", "data": {"pct": 15}}
 
     # Dedupe + per-host cap (stage 1)
@@ -386,7 +666,7 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
     deduped1: List[Dict[str, str]] = []
     for r in results1:
         u = r["url"]; h = host_of(u)
-        if not re.match(r"^https?://", u, re.I): continue
+        if not is_http(u): continue
         if u in seen_urls: continue
         if per_host.get(h, 0) >= MAX_PER_HOST: continue
         seen_urls.add(u); per_host[h] = per_host.get(h, 0) + 1
@@ -395,15 +675,14 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
 
     # Digest pass 1
     yield {"type": "status", "data": {"state": "Fetching & extracting (pass 1)"}}
-    async with httpx.AsyncClient() as client:
-        fetched1 = await fetch_many(urls_stage1, client)
-    docs1: List[Dict[str, str]] = []
+    fetched1 = await fetch_many(urls_stage1, client, min(TOTAL_FETCH_BUDGET, HARD_BUDGET - elapsed()))
+    docs1: List[Dict[str, Any]] = []
     for u in urls_stage1:
         if u in fetched1 and fetched1[u][1]:
             txt = fetched1[u][1]
-            docs1.append({"url": u, "text": txt})
+            docs1.append(make_doc(u, txt))
             yield {"type": "read", "data": {"url": u, "excerpt": txt[:600]}}
-            yield {"type": "extract", "data": {"url": u, "snippets": extract_snippets(txt)}}
+            yield {"type": "extract", "data": {"url": u, "snippets": docs1[-1]["_snips"]}}
             bump_domain(host_of(u), +0.05)
         else:
             bump_domain(host_of(u), -0.02)
@@ -422,12 +701,11 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
 
     # Discover pass 2
     yield {"type": "status", "data": {"state": "Searching the web (pass 2)"}}
-    results2: List[Dict[str, str]] = []
-    for q in plan2["queries"]:
-        if elapsed() > HARD_BUDGET: break
-        res = ddg_search(q, plan2["budgets"]["per_query_results"])
-        results2.extend([{"query": q, **r} for r in res])
+    found2: Dict[str, List[Dict[str, str]]] = {}
+    async for q, res in search_all(plan2["queries"], plan2["budgets"]["per_query_results"], HARD_BUDGET - elapsed()):
+        found2[q] = res
         yield {"type": "search", "data": {"query": q, "results": res}}
+    results2 = [{"query": q, **r} for q in plan2["queries"] for r in found2.get(q, [])]
     yield {"type": "progress", "data": {"pct": 50}}
 
     # Dedupe + per-host cap across both passes
@@ -440,7 +718,7 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
     deduped2: List[Dict[str, str]] = []
     for r in results2:
         u = r["url"]; h = host_of(u)
-        if not re.match(r"^https?://", u, re.I): continue
+        if not is_http(u): continue
         if u in seen_urls: continue
         if per_host.get(h, 0) >= MAX_PER_HOST: continue
         seen_urls.add(u); per_host[h] = per_host.get(h, 0) + 1
@@ -451,46 +729,38 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
 
     # Digest pass 2
     yield {"type": "status", "data": {"state": "Fetching & extracting (pass 2)"}}
-    async with httpx.AsyncClient() as client:
-        fetched2 = await fetch_many(urls_stage2, client)
-    docs2: List[Dict[str, str]] = []
+    fetched2 = await fetch_many(urls_stage2, client, min(TOTAL_FETCH_BUDGET, HARD_BUDGET - elapsed()))
+    docs2: List[Dict[str, Any]] = []
     for u in urls_stage2:
         if u in fetched2 and fetched2[u][1]:
             txt = fetched2[u][1]
-            docs2.append({"url": u, "text": txt})
+            docs2.append(make_doc(u, txt))
             yield {"type": "read", "data": {"url": u, "excerpt": txt[:600]}}
-            yield {"type": "extract", "data": {"url": u, "snippets": extract_snippets(txt)}}
+            yield {"type": "extract", "data": {"url": u, "snippets": docs2[-1]["_snips"]}}
             bump_domain(host_of(u), +0.05)
         else:
             bump_domain(host_of(u), -0.02)
     _save_domain_prior()
 
     # Rank evidence
-    all_docs = docs1 + docs2
-    ranked = sorted(all_docs, key=lambda d: composite_score(question, d["text"], d["url"]), reverse=True)
-    kept: List[Dict[str, str]] = []
-    host_count: Dict[str, int] = {}
-    for d in ranked:
-        h = host_of(d["url"])
-        if host_count.get(h, 0) >= MAX_PER_HOST:
-            continue
-        host_count[h] = host_count.get(h, 0) + 1
-        kept.append(d)
-        if len(kept) >= MAX_DOCS_TOTAL:
-            break
+    kept = select_docs(question, docs1 + docs2)
 
     yield {"type": "progress", "data": {"pct": 70}}
     yield {"type": "status", "data": {"state": "Compressing evidence"}}
 
     # Compress → factlets
     factlets = compress_docs_to_factlets(kept)
-    evidence_lines = []
-    for i, d in enumerate(kept, start=1):
-        evidence_lines.append(f"[{i}] {d['url']}")
-        for fl in factlets:
-            if fl["doc"] == i:
-                evidence_lines.append(f"- {fl['text']}")
-    evidence_blob = "\n".join(evidence_lines)[:120_000]
+    by_doc: Dict[int, List[str]] = defaultdict(list)
+    for fl in factlets:
+        by_doc[fl["doc"]].append(fl["text"])
+    shards = [
+        "\n".join([f"[{i}] {d['url']}"] + [f"- {t}" for t in by_doc[i]])
+        for i, d in enumerate(kept, start=1)
+    ]
+    if sum(approx_tokens(sh) for sh in shards) > MAX_EVIDENCE_TOKENS:
+        yield {"type": "status", "data": {"state": "Condensing evidence"}}
+        shards = await condense_shards(question, shards)
+    evidence_blob = cap_tokens("\n".join(shards), MAX_EVIDENCE_TOKENS)
 
     # Synthesize (evidence-only)
     yield {"type": "status", "data": {"state": "Synthesizing (evidence-only)"}}
@@ -509,23 +779,32 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
         f"Question:\n{question}\n\nEvidence list (map [n] -> URL and bullet factlets):\n{evidence_blob}\n\n"
         "Write the final answer now."
     )
-    draft = llm(
+    parts: List[str] = []
+    # aclosing(): if we are closed mid-synthesis (client gone), the Ollama stream
+    # is closed right away rather than whenever the generator is finalized
+    async with aclosing(llm_stream(
         THOROUGH_MODEL,
         [{"role": "system", "content": synth_sys}, {"role": "user", "content": synth_user}],
         temperature=SYNTH_TEMP,
-    )
+        cache_ttl=SYNTH_CACHE_TTL,
+    )) as toks:
+        async for tok in toks:
+            parts.append(tok)
+            yield {"type": "delta", "data": {"text": tok}}
+    draft = "".join(parts)
 
     # Verify: unsupported-claim filter + citation validation
     yield {"type": "status", "data": {"state": "Verifying claims & citations"}}
     yield {"type": "progress", "data": {"pct": 92}}
 
     sentences = split_sentences(draft)
-    ev_blob_min = "\n".join(d["text"] for d in kept)[:200_000]
+    # same set as tokenizing the joined texts (docs are capped at EXTRACT_CHARS_HTML)
+    ev_tokens = set().union(*(d["_tokens"] for d in kept))
     checked: List[str] = []
     for s in sentences:
-        if re.match(r"^\s*\[[0-9]+\]\s*$", s):
+        if is_bare_citation(s):
             continue
-        if sentence_supported(s, ev_blob_min):
+        if sentence_supported(s, ev_tokens):
             checked.append(s)
         else:
             checked.append(s + " _(not supported by the provided sources)_")
@@ -545,28 +824,51 @@ async def thorough_stream(question: str) -> AsyncGenerator[Dict[str, Any], None]
 # =========================================================
 # API
 # =========================================================
+@app.on_event("startup")
+async def _startup():
+    global EXTRACTOR_POOL
+    EXTRACTOR_POOL = _new_extractor_pool()
+    # one pooled HTTP/2 client for every fetch, so pass 1 and pass 2 reuse connections
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(20.0),
+        headers={"user-agent": USER_AGENT},
+    )
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await app.state.http.aclose()
+    if EXTRACTOR_POOL is not None:
+        EXTRACTOR_POOL.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/api/stream_chat")
 async def api_stream_chat(request: Request, question: str, mode: str = "fast"):
     """
     Server-Sent Events stream.
     mode = "fast" | "thorough"
     """
+    def sse(event: str, data: Any) -> bytes:
+        return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
     async def event_gen():
         try:
             if mode == "fast":
                 async for ev in fast_stream(question):
-                    yield f"event: {ev['type']}\ndata: {json.dumps(ev['data'])}\n\n"
+                    yield sse(ev["type"], ev["data"])
             else:
-                # Ultra-Thorough 5-min pipeline
-                async for ev in thorough_stream(question):
-                    # stop gracefully if client disconnected
-                    if await request.is_disconnected():
-                        break
-                    yield f"event: {ev['type']}\ndata: {json.dumps(ev['data'])}\n\n"
+                # Ultra-Thorough 5-min pipeline; aclosing() so a disconnect also
+                # closes an in-flight synthesis stream instead of waiting for GC
+                async with aclosing(thorough_stream(question, request.app.state.http)) as events:
+                    async for ev in events:
+                        # stop gracefully if client disconnected
+                        if await request.is_disconnected():
+                            break
+                        yield sse(ev["type"], ev["data"])
         except asyncio.CancelledError:
             # client aborted
             return
         except Exception as e:
-            yield f"event: error\ndata: {json.dumps({'message': str(e)})}\n\n"
+            yield sse("error", {"message": str(e)})
 
     return StreamingResponse(event_gen(), media_type="text/event-stream")
@@ -190,14 +190,29 @@ export default function App(){
     es.addEventListener("extract",(ev)=> appendTrace(id,{type:"extract",data:JSON.parse(ev.data)}));
     es.addEventListener("rationale",(ev)=> appendTrace(id,{type:"rationale",data:JSON.parse(ev.data)}));
 
+    // live draft while the answer is synthesized; "final" replaces it with the verified answer
+    const draftId = uid();
+    const dropDraft = (msgs)=> msgs.filter(m=>m.id!==draftId);
+    es.addEventListener("delta", (ev)=>{
+      const d = JSON.parse(ev.data);
+      setSessions(prev=>prev.map(s=>{
+        if (s.id!==id) return s;
+        const has = s.messages.some(m=>m.id===draftId);
+        return {...s, messages: has
+          ? s.messages.map(m=> m.id===draftId ? {...m, content:m.content+(d.text||"")} : m)
+          : [...s.messages, {id:draftId, role:"assistant", content:d.text||"", citations:[]}]};
+      }));
+    });
+
     es.addEventListener("final",  (ev)=>{
       const d = JSON.parse(ev.data);
-      setSessions(prev=>prev.map(s=> s.id===id ? {...s, messages:[...s.messages, {id:uid(), role:"assistant", content:d.answer, citations:d.citations}]} : s));
+      setSessions(prev=>prev.map(s=> s.id===id ? {...s, messages:[...dropDraft(s.messages), {id:uid(), role:"assistant", content:d.answer, citations:d.citations}]} : s));
       setProgress(100); setStatus("done"); stopTimer(); es.close();
       setTimeout(()=> setProgress(0), 800);
     });
     es.addEventListener("error",  ()=>{
       appendTrace(id, {type:"error", data:{message:"Network/server error"}});
+      setSessions(prev=>prev.map(s=> s.id===id ? {...s, messages:dropDraft(s.messages)} : s));
       setStatus("error"); stopTimer(); es.close();
     });
   }